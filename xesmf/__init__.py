@@ -1,4 +1,4 @@
 __version__='0.3.1'
 from . import util
 from . import data
-from . frontend import Regridder
+from . frontend import Regridder, get_regridder, clear_regridder_cache
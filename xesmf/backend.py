@@ -103,7 +103,8 @@ def esmf_grid(lon, lat, periodic=False):
                      num_peri_dims=num_peri_dims)
 
     # The grid object points to the underlying Fortran arrays in ESMF.
-    # To modify lat/lon coordinates, need to get pointers to them
+    # To modify lat/lon coordinates, need to get pointers to them.
+    # ESMF allocates these arrays itself, so this one copy cannot be avoided.
     lon_pointer = grid.get_coords(coord_dim=0, staggerloc=staggerloc)
     lat_pointer = grid.get_coords(coord_dim=1, staggerloc=staggerloc)
 
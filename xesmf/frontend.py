@@ -5,6 +5,8 @@ Frontend for xESMF, exposed to users.
 import numpy as np
 import xarray as xr
 import os
+import hashlib
+import inspect
 import warnings
 
 from . backend import (esmf_grid, esmf_locstream, add_corner,
@@ -18,18 +20,35 @@ try:
 except ImportError:
     dask_array_type = ()
 
+# Regridder objects built by get_regridder(), keyed by grids and options
+_REGRIDDER_CACHE = {}
+
 def as_2d_mesh(lon, lat):
 
     if (lon.ndim, lat.ndim) == (2, 2):
         assert lon.shape == lat.shape, 'lon and lat should have same shape'
     elif (lon.ndim, lat.ndim) == (1, 1):
-        lon, lat = np.meshgrid(lon, lat)
+        # read-only views like np.meshgrid(lon, lat), without allocating
+        # the 2D arrays until they are actually needed
+        shape = (lat.size, lon.size)
+        lon = np.broadcast_to(lon[np.newaxis, :], shape)
+        lat = np.broadcast_to(lat[:, np.newaxis], shape)
     else:
         raise ValueError('lon and lat should be both 1D or 2D')
 
     return lon, lat
 
 
+def _esmf_layout(a):
+    '''
+    Transpose a 2D C-ordered coordinate array to the Fortran-ordered float64
+    layout of ESMF coordinates, so that copying it into ESMF is a plain
+    memory copy. No copy is made for 2D float64 C-ordered input; 1D input
+    broadcasted by as_2d_mesh() is materialized here.
+    '''
+    return np.require(a.T, dtype=np.float64, requirements='F')
+
+
 def ds_to_ESMFgrid(ds, need_bounds=False, periodic=None, append=None):
     '''
     Convert xarray DataSet or dictionary to ESMF.Grid object.
@@ -61,9 +80,9 @@ def ds_to_ESMFgrid(ds, need_bounds=False, periodic=None, append=None):
     lon, lat = as_2d_mesh(lon, lat)
 
     # tranpose the arrays so they become Fortran-ordered
-    grid = esmf_grid(lon.T, lat.T, periodic=periodic)
+    grid = esmf_grid(_esmf_layout(lon), _esmf_layout(lat), periodic=periodic)
     # detect ds["mask"] and add it to the grid
-    if 'mask' in ds.data_vars:
+    if 'mask' in getattr(ds, 'data_vars', ds):
         import ESMF
         grid.add_item(ESMF.GridItem.MASK, staggerloc=ESMF.StaggerLoc.CENTER)
         grid.mask[0][...] = np.asarray(ds['mask']).T
@@ -72,7 +91,7 @@ def ds_to_ESMFgrid(ds, need_bounds=False, periodic=None, append=None):
         lon_b = np.asarray(ds['lon_b'])
         lat_b = np.asarray(ds['lat_b'])
         lon_b, lat_b = as_2d_mesh(lon_b, lat_b)
-        add_corner(grid, lon_b.T, lat_b.T)
+        add_corner(grid, _esmf_layout(lon_b), _esmf_layout(lat_b))
 
     return grid, lon.shape
 
@@ -107,6 +126,92 @@ def ds_to_ESMFlocstream(ds):
     return locstream, (1,) + lon.shape
 
 
+def _grid_coords(ds):
+    '''The variables of ``ds`` that describe a grid.'''
+    return {name: ds[name] for name in ['lon', 'lat', 'lon_b', 'lat_b', 'mask']
+            if name in ds}
+
+
+def _grid_fingerprint(ds):
+    '''
+    Hash the coordinates of a grid, so that identical grids can be detected
+    without keeping a copy of them around.
+
+    Parameters
+    ----------
+    ds : xarray DataSet or dictionary
+        Contains variables ``lon``, ``lat``,
+        and optionally ``lon_b``, ``lat_b`` and ``mask``.
+
+    Returns
+    -------
+    fingerprint : str
+
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    for name, coord in _grid_coords(ds).items():
+        a = np.ascontiguousarray(coord)
+        # dimension names end up in the output, so they are part of the grid
+        dims = getattr(coord, 'dims', None)
+        h.update(repr((name, dims, a.dtype.str, a.shape)).encode())
+        h.update(a.data)
+
+    return h.hexdigest()
+
+
+def get_regridder(ds_in, ds_out, method, **kwargs):
+    '''
+    Same as ``Regridder(ds_in, ds_out, method, **kwargs)``, but reuse a
+    regridder previously built by this function if the grids and options
+    are identical, so that the weights are only computed once.
+
+    Cached regridders are kept in memory until ``clear_regridder_cache()``
+    is called. Regridders built from existing ``weights`` are never cached.
+
+    Returns
+    -------
+    regridder : xESMF regridder object
+
+    '''
+    if kwargs.get('weights') is not None:
+        return Regridder(ds_in, ds_out, method, **kwargs)
+
+    kwargs.pop('weights', None)
+    # options spelled out at their default share the cache entry
+    options = inspect.signature(Regridder).bind(ds_in, ds_out, method,
+                                                **kwargs)
+    options.apply_defaults()
+    options = {name: value for name, value in options.arguments.items()
+               if name not in ('ds_in', 'ds_out', 'weights')}
+
+    fingerprints = (_grid_fingerprint(ds_in), _grid_fingerprint(ds_out))
+    key = (tuple(sorted(options.items())),) + fingerprints
+
+    try:
+        return _REGRIDDER_CACHE[key]
+    except KeyError:
+        regridder = Regridder(ds_in, ds_out, method, **kwargs)
+        # no need to hash the grids again for the default filename
+        regridder._grid_fingerprints = fingerprints
+        regridder._grid_coords = None
+        _REGRIDDER_CACHE[key] = regridder
+        return regridder
+
+
+def clear_regridder_cache():
+    '''Free all regridders cached by ``get_regridder()``.'''
+    _REGRIDDER_CACHE.clear()
+
+
+def _dtype_groups(ds):
+    '''Names of the data variables of ``ds``, grouped by dtype.'''
+    groups = {}
+    for name, dr in ds.data_vars.items():
+        groups.setdefault(dr.dtype, []).append(name)
+
+    return groups
+
+
 class Regridder(object):
     def __init__(self, ds_in, ds_out, method, periodic=False,
                  extrap=None, extrap_exp=None, extrap_num_pnts=None,
@@ -154,13 +259,14 @@ class Regridder(object):
             The number of source points to use for the extrapolation methods
             that use more than one source point. If none are specified, defaults to 8
 
-        weights : None, coo_matrix, dict, str, Dataset, Path,
+        weights : None, sparse matrix, dict, str, Dataset, Path,
             Regridding weights, stored as
-              - a scipy.sparse COO matrix,
+              - a scipy.sparse matrix, e.g. ``weights`` of another regridder,
               - a dictionary with keys `row_dst`, `col_src` and `weights`,
               - an xarray Dataset with data variables `col`, `row` and `S`,
               - or a path to a netCDF file created by ESMF.
-            If None, compute the weights.
+            If None, compute the weights. They are kept in memory and only
+            written to disk by ``to_netcdf()``.
 
         ignore_degenerate : bool, optional
             If False (default), raise error if grids contain degenerated cells
@@ -194,6 +300,11 @@ class Regridder(object):
         self.locstream_in = locstream_in
         self.locstream_out = locstream_out
 
+        # hashing large grids is slow, so only do it when a default weight
+        # filename is needed. Keep the coordinates, not the whole Datasets.
+        self._grid_coords = (_grid_coords(ds_in), _grid_coords(ds_out))
+        self._grid_fingerprints = None
+
         methods_avail_ls_in = ['nearest_s2d', 'nearest_d2s']
         methods_avail_ls_out = ['bilinear', 'patch'] + methods_avail_ls_in
 
@@ -202,7 +313,9 @@ class Regridder(object):
         if locstream_out and self.method not in methods_avail_ls_out:
             raise ValueError(f'locstream output is only available for method in {methods_avail_ls_out}')
 
-        # construct ESMF grid, with some shape checking
+        # construct ESMF grid, with some shape checking.
+        # The two grids are built one after the other on purpose: ESMPy is
+        # not thread-safe, and ESMF objects cannot be sent across processes.
         if locstream_in:
             self._grid_in, shape_in = ds_to_ESMFlocstream(ds_in)
         else:
@@ -218,27 +331,35 @@ class Regridder(object):
                                                        )
 
         # record output grid and metadata
-        self._lon_out = np.asarray(ds_out['lon'])
-        self._lat_out = np.asarray(ds_out['lat'])
+        lon_out = ds_out['lon']
+        lat_out = ds_out['lat']
+        self._lon_out = np.asarray(lon_out)
+        self._lat_out = np.asarray(lat_out)
 
-        if self._lon_out.ndim == 2:
-            try:
-                self.lon_dim = self.lat_dim = ds_out['lon'].dims
-            except:
-                self.lon_dim = self.lat_dim = ('y', 'x')
+        # plain numpy arrays from a dictionary have no dimension names
+        lon_dims = getattr(lon_out, 'dims', None)
+        lat_dims = getattr(lat_out, 'dims', None)
 
+        if self._lon_out.ndim == 2:
+            self.lon_dim = self.lat_dim = lon_dims or ('y', 'x')
             self.out_horiz_dims = self.lon_dim
 
         elif self._lon_out.ndim == 1:
-            try:
-                self.lon_dim, = ds_out['lon'].dims
-                self.lat_dim, = ds_out['lat'].dims
-            except:
-                self.lon_dim = 'lon'
-                self.lat_dim = 'lat'
-
+            self.lon_dim, = lon_dims or ('lon',)
+            self.lat_dim, = lat_dims or ('lat',)
             self.out_horiz_dims = (self.lat_dim, self.lon_dim)
 
+        # output grid coordinates, built once and attached to every output.
+        # For 1D lon/lat, this also builds their pandas index only once.
+        if locstream_out:
+            lon_dims = lat_dims = ('locations',)
+        else:
+            lon_dims, lat_dims = self.lon_dim, self.lat_dim
+        self._out_coords = xr.Dataset(
+            coords={'lon': (lon_dims, self._lon_out),
+                    'lat': (lat_dims, self._lat_out)}
+        ).coords
+
         # record grid shape information
         self.shape_in = shape_in
         self.shape_out = shape_out
@@ -248,8 +369,14 @@ class Regridder(object):
         if weights is None:
             weights = self._compute_weights()  # Dictionary of weights
 
-        # Convert weights, whatever their format, to a sparse coo matrix
-        self.weights = read_weights(weights, self.n_in, self.n_out)
+        # Convert weights, whatever their format, to a sparse matrix.
+        # CSR is much faster than COO for applying weights to many fields
+        # at once, so do the conversion only once here.
+        self.weights = read_weights(weights, self.n_in, self.n_out).tocsr()
+        # Input points are then read in increasing order within each row.
+        # This is a no-op if scipy already sorted them during the conversion.
+        self.weights.sort_indices()
+        self._weights_f32 = None  # built on first float32 input
 
     @property
     def A(self):
@@ -265,17 +392,31 @@ class Regridder(object):
         return self.weights
 
     def _get_default_filename(self):
-        # e.g. bilinear_400x600_300x400.nc
-        filename = ('{0}_{1}x{2}_{3}x{4}'.format(self.method,
-                    self.shape_in[0], self.shape_in[1],
-                    self.shape_out[0], self.shape_out[1],)
-                    )
+        # e.g. bilinear_400x600_300x400_1f2e3d4c5b6a.nc
+        filename = (f'{self.method}_{self.shape_in[0]}x{self.shape_in[1]}_'
+                    f'{self.shape_out[0]}x{self.shape_out[1]}')
         if self.periodic:
-            filename += '_peri.nc'
-        else:
-            filename += '.nc'
-
-        return filename
+            filename += '_peri'
+
+        return f'{filename}_{self._grid_hash()}.nc'
+
+    def _grid_hash(self):
+        '''
+        Identifies the grids and options that determine the weights,
+        so that default weight filenames differ when any of them differ.
+        '''
+        if self._grid_fingerprints is None:
+            self._grid_fingerprints = tuple(_grid_fingerprint(coords)
+                                            for coords in self._grid_coords)
+            self._grid_coords = None
+
+        h = hashlib.blake2b(digest_size=6)
+        for fingerprint in self._grid_fingerprints:
+            h.update(fingerprint.encode())
+        h.update(repr((self.extrap, self.extrap_exp, self.extrap_num_pnts,
+                       self.ignore_degenerate, self.locstream_in,
+                       self.locstream_out)).encode())
+        return h.hexdigest()
 
     def _compute_weights(self):
         regrid = esmf_regrid_build(self._grid_in, self._grid_out, self.method,
@@ -321,6 +462,9 @@ class Regridder(object):
             Transpose your input data if the horizontal dimensions are not
             the rightmost two dimensions.
 
+            For a Dataset, the horizontal dimensions are taken from the first
+            data variable. Data variables without them are dropped.
+
         keep_attrs : bool, optional
             Keep attributes for xarray DataArrays or Datasets.
             Defaults to False.
@@ -330,6 +474,7 @@ class Regridder(object):
         outdata : Data type is the same as input data type.
             On the same horizontal grid as ``ds_out``,
             with extra dims in ``dr_in``.
+            float32 input gives float32 output, other input gives float64.
 
             Assuming ``ds_out`` has the shape of (n_y_out, n_x_out),
             examples of returning shapes are
@@ -353,14 +498,36 @@ class Regridder(object):
                 "input must be numpy array, dask array, "
                 "xarray DataArray or Dataset!")
 
-    def regrid_numpy(self, indata):
-        """See __call__()."""
+    def _weights_for(self, dtype):
+        '''
+        Weights to apply to input data of the given dtype.
+
+        float32 input gets float32 weights, so the output stays float32 and
+        half as many bytes are moved when applying the weights.
+        '''
+        if dtype != np.float32:
+            return self.weights
+
+        if self._weights_f32 is None:
+            self._weights_f32 = self.weights.astype(np.float32)
+        return self._weights_f32
+
+    def _output_dtype(self, dtype):
+        return np.result_type(dtype, self._weights_for(dtype).dtype)
+
+    def regrid_numpy(self, indata, out=None):
+        """
+        See __call__().
+
+        ``out`` is an optional C-ordered numpy array to write the output to,
+        see ``xesmf.smm.apply_weights()``.
+        """
 
         if self.locstream_in:
             indata = np.expand_dims(indata, axis=-2)
 
-        outdata = apply_weights(self.weights, indata,
-                                self.shape_in, self.shape_out)
+        outdata = apply_weights(self._weights_for(indata.dtype), indata,
+                                self.shape_in, self.shape_out, out=out)
         return outdata
 
     def regrid_dask(self, indata):
@@ -373,14 +540,17 @@ class Regridder(object):
         outdata = da.map_blocks(
             self.regrid_numpy,
             indata,
-            dtype=float,
+            dtype=self._output_dtype(indata.dtype),
             chunks=output_chunk_shape
         )
 
         return outdata
 
-    def regrid_dataarray(self, dr_in, keep_attrs=False):
-        """See __call__()."""
+    def _horiz_dims(self, dr_in):
+        """
+        Input horizontal dimensions of ``dr_in``, and the temporary names
+        used for the output horizontal dimensions.
+        """
 
         # example: ('lat', 'lon') or ('y', 'x')
         if self.locstream_in:
@@ -399,22 +569,17 @@ class Regridder(object):
         if self.locstream_in and not self.locstream_out:
             temp_horiz_dims = ['dummy_new'] + temp_horiz_dims
 
+        return input_horiz_dims, temp_horiz_dims
 
-        dr_out = xr.apply_ufunc(
-            self.regrid_numpy, dr_in,
-            input_core_dims=[input_horiz_dims],
-            output_core_dims=[temp_horiz_dims],
-            dask='parallelized',
-            output_dtypes=[float],
-            output_sizes={temp_horiz_dims[0]: self.shape_out[0],
-                          temp_horiz_dims[1]: self.shape_out[1]
-                          },
-            keep_attrs=keep_attrs
-        )
+    def _format_output(self, out, temp_horiz_dims):
+        """
+        Rename the horizontal dimensions of a regridded DataArray or Dataset
+        and attach the output grid coordinates.
+        """
 
         if not self.locstream_out:
             # rename dimension name to match output grid
-            dr_out = dr_out.rename(
+            out = out.rename(
                 {temp_horiz_dims[0]: self.out_horiz_dims[0],
                  temp_horiz_dims[1]: self.out_horiz_dims[1]
                 }
@@ -422,19 +587,34 @@ class Regridder(object):
 
         # append output horizontal coordinate values
         # extra coordinates are automatically tracked by apply_ufunc
-        if self.locstream_out:
-            dr_out.coords['lon'] = xr.DataArray(self._lon_out, dims=('locations',))
-            dr_out.coords['lat'] = xr.DataArray(self._lat_out, dims=('locations',))
-        else:
-            dr_out.coords['lon'] = xr.DataArray(self._lon_out, dims=self.lon_dim)
-            dr_out.coords['lat'] = xr.DataArray(self._lat_out, dims=self.lat_dim)
+        out = out.assign_coords(self._out_coords)
 
-        dr_out.attrs['regrid_method'] = self.method
+        out.attrs['regrid_method'] = self.method
 
         if self.locstream_out:
-            dr_out = dr_out.squeeze(dim='dummy')
+            out = out.squeeze(dim='dummy')
+
+        return out
+
+    def regrid_dataarray(self, dr_in, keep_attrs=False):
+        """See __call__()."""
 
-        return dr_out
+        input_horiz_dims, temp_horiz_dims = self._horiz_dims(dr_in)
+
+        dr_out = xr.apply_ufunc(
+            self.regrid_numpy, dr_in,
+            input_core_dims=[input_horiz_dims],
+            output_core_dims=[temp_horiz_dims],
+            dask='parallelized',
+            output_dtypes=[self._output_dtype(dr_in.dtype)],
+            dask_gufunc_kwargs={
+                'output_sizes': {temp_horiz_dims[0]: self.shape_out[0],
+                                 temp_horiz_dims[1]: self.shape_out[1]}
+            },
+            keep_attrs=keep_attrs
+        )
+
+        return self._format_output(dr_out, temp_horiz_dims)
 
     def regrid_dataset(self, ds_in, keep_attrs=False):
         """See __call__()."""
@@ -445,19 +625,7 @@ class Regridder(object):
 
         # get the first data variable to infer input_core_dims
         name, dr_in = next(iter(ds_in.items()))
-
-        if self.locstream_in:
-            input_horiz_dims = dr_in.dims[-1:]
-        else:
-            input_horiz_dims = dr_in.dims[-2:]
-
-        if self.locstream_out:
-            temp_horiz_dims = ['dummy', 'locations']
-        else:
-            temp_horiz_dims = [s + '_new' for s in input_horiz_dims]
-
-        if self.locstream_in and not self.locstream_out:
-            temp_horiz_dims = ['dummy_new'] + temp_horiz_dims
+        input_horiz_dims, temp_horiz_dims = self._horiz_dims(dr_in)
 
         # help user debugging invalid horizontal dimensions
         print('using dimensions {} from data variable {} '
@@ -465,47 +633,95 @@ class Regridder(object):
               .format(input_horiz_dims, name)
               )
 
-        ds_out = xr.apply_ufunc(
-            self.regrid_numpy, ds_in,
-            input_core_dims=[input_horiz_dims],
-            output_core_dims=[temp_horiz_dims],
-            dask='parallelized',
-            output_dtypes=[float],
-            output_sizes={temp_horiz_dims[0]: self.shape_out[0],
-                          temp_horiz_dims[1]: self.shape_out[1]
-                          },
-            keep_attrs=keep_attrs
-        )
-
-        if not self.locstream_out:
-            # rename dimension name to match output grid
-            ds_out = ds_out.rename(
-                {temp_horiz_dims[0]: self.out_horiz_dims[0],
-                 temp_horiz_dims[1]: self.out_horiz_dims[1]
-                }
-            )
-
-        # append output horizontal coordinate values
-        # extra coordinates are automatically tracked by apply_ufunc
-        if self.locstream_out:
-            ds_out.coords['lon'] = xr.DataArray(self._lon_out, dims=('locations',))
-            ds_out.coords['lat'] = xr.DataArray(self._lat_out, dims=('locations',))
+        # data variables without the horizontal dimensions cannot be regridded
+        non_regriddable = [name for name, dr in ds_in.data_vars.items()
+                           if not set(input_horiz_dims).issubset(dr.dims)]
+        ds_in = ds_in.drop_vars(non_regriddable)
+
+        if any(isinstance(dr.data, dask_array_type)
+               for dr in ds_in.data_vars.values()):
+            # one apply_ufunc per dtype, so that dask knows the output dtype
+            regridded = xr.merge([
+                xr.apply_ufunc(
+                    self.regrid_numpy, ds_in[names],
+                    input_core_dims=[input_horiz_dims],
+                    output_core_dims=[temp_horiz_dims],
+                    dask='parallelized',
+                    output_dtypes=[self._output_dtype(dtype)],
+                    dask_gufunc_kwargs={
+                        'output_sizes': {
+                            temp_horiz_dims[0]: self.shape_out[0],
+                            temp_horiz_dims[1]: self.shape_out[1]}
+                    },
+                    keep_attrs=keep_attrs
+                )
+                for dtype, names in _dtype_groups(ds_in).items()
+            ])
+            out_vars = {name: regridded[name].variable
+                        for name in ds_in.data_vars}
+            ds_out = self._assemble_dataset(ds_in, out_vars, input_horiz_dims,
+                                            keep_attrs)
         else:
-            ds_out.coords['lon'] = xr.DataArray(self._lon_out, dims=self.lon_dim)
-            ds_out.coords['lat'] = xr.DataArray(self._lat_out, dims=self.lat_dim)
+            ds_out = self._regrid_dataset_numpy(ds_in, input_horiz_dims,
+                                                temp_horiz_dims, keep_attrs)
 
-        ds_out.attrs['regrid_method'] = self.method
+        return self._format_output(ds_out, temp_horiz_dims)
 
-        if self.locstream_out:
-            ds_out = ds_out.squeeze(dim='dummy')
+    def _regrid_dataset_numpy(self, ds_in, input_horiz_dims, temp_horiz_dims,
+                              keep_attrs=False):
+        """
+        Regrid all in-memory data variables of ``ds_in``, applying the weights
+        only once to all variables of the same dtype.
+        Output is like ``xr.apply_ufunc(self.regrid_numpy, ds_in, ...)``.
+        """
 
-        return ds_out
+        # move horizontal dimensions to the end, like apply_ufunc
+        data_vars = {name: dr.transpose(..., *input_horiz_dims)
+                     for name, dr in ds_in.data_vars.items()}
+
+        outdata = {}
+        for names in _dtype_groups(ds_in).values():
+            # stack all variables along a single extra dimension
+            horiz_shape = data_vars[names[0]].shape[-len(input_horiz_dims):]
+            indata = [data_vars[name].values.reshape(-1, *horiz_shape)
+                      for name in names]
+            # a single variable does not need to be copied
+            indata = indata[0] if len(indata) == 1 else np.concatenate(indata)
+            outdata_stacked = self.regrid_numpy(indata)
+
+            start = 0
+            for name in names:
+                extra_shape = data_vars[name].shape[:-len(input_horiz_dims)]
+                stop = start + int(np.prod(extra_shape))
+                outdata[name] = outdata_stacked[start:stop].reshape(
+                    extra_shape + outdata_stacked.shape[-2:])
+                start = stop
+
+        out_vars = {}
+        for name, dr in data_vars.items():
+            extra_dims = dr.dims[:-len(input_horiz_dims)]
+            out_vars[name] = xr.Variable(
+                extra_dims + tuple(temp_horiz_dims), outdata[name],
+                attrs=dr.attrs if keep_attrs else None)
+
+        return self._assemble_dataset(ds_in, out_vars, input_horiz_dims,
+                                      keep_attrs)
+
+    @staticmethod
+    def _assemble_dataset(ds_in, out_vars, input_horiz_dims, keep_attrs):
+        '''Regridded variables into a Dataset, like ``xr.apply_ufunc``.'''
+        # extra coordinates are kept, like apply_ufunc
+        coords = {name: coord for name, coord in ds_in.coords.items()
+                  if not set(input_horiz_dims) & set(coord.dims)}
+
+        return xr.Dataset(out_vars, coords=coords,
+                          attrs=ds_in.attrs if keep_attrs else None)
 
     def to_netcdf(self, filename=None):
         '''Save weights to disk as a netCDF file.'''
         if filename is None:
             filename = self._get_default_filename()
-        w = self.weights
+        w = self.weights.tocoo()
         ds = xr.Dataset({"S": w.data, "col": w.col + 1, "row": w.row + 1})
         ds.to_netcdf(filename)
         return filename
@@ -1,21 +1,42 @@
 """
-Sparse matrix multiplication (SMM) using scipy.sparse library.
+Sparse matrix multiplication (SMM) using scipy.sparse library,
+or a numba kernel if numba is installed. The numba kernel is multi-threaded
+when called from the main thread, and single-threaded from other threads
+such as dask workers, which already run in parallel.
 """
 
+import numpy as np
 import xarray as xr
 import scipy.sparse as sps
+import threading
 import warnings
 from pathlib import Path
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# scipy's C++ kernel behind CSR matrix times dense matrix. It is private,
+# so fall back to the public API if it ever moves.
+try:
+    from scipy.sparse._sparsetools import csr_matvec, csr_matvecs
+except ImportError:
+    csr_matvec = csr_matvecs = None
+
+# numpy dtypes handled by the numba kernel, others fall back to scipy
+_numba_dtypes = np.typecodes['AllInteger'] + 'fd'
+
 
 def read_weights(weights, n_in, n_out):
     '''
-    Read regridding weights into a scipy sparse COO matrix.
+    Read regridding weights into a scipy sparse matrix.
 
     Parameters
     ----------
-    filename : str
-        Offline weight file generated by ESMPy.
+    weights : str, Path, xarray Dataset, dict or scipy sparse matrix
+        Offline weight file generated by ESMPy, or weights already in memory.
+        See ``Regridder`` for details.
 
     N_in, N_out : integers
         ``(N_out, N_in)`` will be the shape of the returning sparse matrix.
@@ -29,34 +50,62 @@ def read_weights(weights, n_in, n_out):
 
     Returns
     -------
-    A : scipy sparse COO matrix.
+    A : scipy sparse matrix.
+        COO unless ``weights`` already is a sparse matrix in another format.
 
     '''
-    if isinstance(weights, (str, Path, xr.Dataset)):
-        if not isinstance(weights, xr.Dataset):
-            ds_w = xr.open_dataset(weights)
-        col = ds_w['col'].values - 1  # Python starts with 0
-        row = ds_w['row'].values - 1
-        S = ds_w['S'].values
+    if isinstance(weights, (str, Path)):
+        # close the file as soon as the weights are in memory
+        with xr.open_dataset(weights) as ds_w:
+            return read_weights(ds_w, n_in, n_out)
+
+    elif isinstance(weights, xr.Dataset):
+        col = weights['col'].values - 1  # Python starts with 0
+        row = weights['row'].values - 1
+        S = weights['S'].values
 
     elif isinstance(weights, dict):
         col = weights['col_src'] - 1
         row = weights['row_dst'] - 1
         S = weights['weights']
 
-    elif isinstance(weights, sps.coo_matrix):
+    elif sps.issparse(weights):
+        # e.g. the CSR weights of another Regridder
         return weights
 
     return sps.coo_matrix((S, (row, col)), shape=[n_out, n_in])
 
 
-def apply_weights(weights, indata, shape_in, shape_out):
+def _all_nan(a, n_samples=64, chunk_size=2**20):
+    '''
+    Whether a 2D floating point array only contains NaN.
+    Looks at a few values spread over the array first, then at blocks of
+    rows of about ``chunk_size`` values, stopping at the first value that is
+    not NaN. This keeps it cheap for data with missing values, e.g. masked
+    land points, without a boolean array as large as ``a``.
+    '''
+    if a.dtype.kind != 'f' or a.size == 0:
+        return False
+
+    samples = np.linspace(0, a.size - 1, min(n_samples, a.size)).astype(int)
+    if not np.isnan(a.flat[samples]).all():
+        return False
+
+    n_rows = max(1, chunk_size // a.shape[1])
+    for start in range(0, a.shape[0], n_rows):
+        if not np.isnan(a[start:start + n_rows]).all():
+            return False
+
+    return True
+
+
+def apply_weights(weights, indata, shape_in, shape_out, out=None):
     '''
     Apply regridding weights to data.
 
     Parameters
     ----------
-    A : scipy sparse COO matrix
+    A : scipy sparse COO or CSR matrix
 
     indata : numpy array of shape ``(..., n_lat, n_lon)`` or ``(..., n_y, n_x)``.
         Should be C-ordered. Will be then tranposed to F-ordered.
@@ -65,16 +114,23 @@ def apply_weights(weights, indata, shape_in, shape_out):
         Input/output data shape for unflatten operation.
         For rectilinear grid, it is just ``(n_lat, n_lon)``.
 
+    out : numpy array of shape ``(..., shape_out[0], shape_out[1])``, optional
+        C-ordered array to write the output to, e.g. to reuse the same memory
+        when regridding time steps one by one in a loop. Its dtype should be
+        that of the result. With CSR weights, the output is written directly
+        to ``out`` without allocating a temporary array of the same size.
+
     Returns
     -------
     outdata : numpy array of shape ``(..., shape_out[0], shape_out[1])``.
         Extra dimensions are the same as `indata`.
         If input data is C-ordered, output will also be C-ordered.
+        This is ``out`` if it was given.
     '''
 
-    # COO matrix is fast with F-ordered array but slow with C-array, so we
-    # take in a C-ordered and then transpose)
-    # (CSR or CRS matrix is fast with C-ordered array but slow with F-array)
+    # We take in a C-ordered array and then transpose it, which works for
+    # both COO and CSR matrices. CSR is preferred since scipy applies it to
+    # all the extra dimensions in a single pass.
     if not indata.flags['C_CONTIGUOUS']:
         warnings.warn("Input array is not C_CONTIGUOUS. "
                       "Will affect performance.")
@@ -83,22 +139,143 @@ def apply_weights(weights, indata, shape_in, shape_out):
     shape_horiz = indata.shape[-2:]
     extra_shape = indata.shape[0:-2]
 
-    assert shape_horiz == shape_in, (
-        'The horizontal shape of input data is {}, different from that of'
-        'the regridder {}!'.format(shape_horiz, shape_in)
-        )
+    # explicit checks instead of assert, so they also run with python -O
+    if shape_horiz != shape_in:
+        raise ValueError(
+            'The horizontal shape of input data is {}, different from that '
+            'of the regridder {}!'.format(shape_horiz, shape_in))
 
-    assert shape_in[0] * shape_in[1] == weights.shape[1], (
-        "ny_in * nx_in should equal to weights.shape[1]")
+    if shape_in[0] * shape_in[1] != weights.shape[1]:
+        raise ValueError("ny_in * nx_in should equal to weights.shape[1]")
 
-    assert shape_out[0] * shape_out[1] == weights.shape[0], (
-        "ny_out * nx_out should equal to weights.shape[0]")
+    if shape_out[0] * shape_out[1] != weights.shape[0]:
+        raise ValueError("ny_out * nx_out should equal to weights.shape[0]")
 
     # use flattened array for dot operation
     indata_flat = indata.reshape(-1, shape_in[0]*shape_in[1])
-    outdata_flat = weights.dot(indata_flat.T).T
+    n_extra = indata_flat.shape[0]
+    n_out, n_in = weights.shape
+    dtype = np.result_type(indata.dtype, weights.dtype)
+    outdata_shape = (*extra_shape, shape_out[0], shape_out[1])
+    if out is None:
+        outdata_flat_T = None
+    else:
+        if (out.shape != outdata_shape or out.dtype != dtype
+                or not out.flags['C_CONTIGUOUS']):
+            raise ValueError('out should be a C-ordered {} array of shape {}'
+                             .format(dtype, outdata_shape))
+        # a view, everything written to it goes to out
+        outdata_flat_T = out.reshape(n_extra, n_out).T
+
+    if _all_nan(indata_flat):
+        # e.g. a time step without any data. No need to apply the weights:
+        # output boxes with weights are NaN and unmapped boxes are 0.
+        if outdata_flat_T is None:
+            outdata_flat_T = np.empty((n_out, n_extra), dtype=dtype)
+        # stored weights per output box, for sparse matrices and arrays
+        if weights.format == 'csr':
+            n_weights = np.diff(weights.indptr)
+        else:
+            n_weights = np.bincount(weights.tocoo().row, minlength=n_out)
+        outdata_flat_T[...] = np.where(n_weights > 0, np.nan, 0)[:, np.newaxis]
+    elif (numba is not None and weights.format == 'csr'
+            and indata.dtype.char in _numba_dtypes
+            and indata.dtype.isnative):
+        if outdata_flat_T is None:
+            outdata_flat_T = np.empty((n_out, n_extra), dtype=dtype)
+        _numba_kernel()(weights.indptr, weights.indices, weights.data,
+                        np.ascontiguousarray(indata_flat.T), outdata_flat_T)
+    elif csr_matvecs is not None and weights.format == 'csr':
+        # Same as weights.dot(indata_flat.T), without scipy's checks and
+        # dispatching on every call. The kernels add to the output,
+        # so start at 0.
+        data = weights.data.astype(dtype, copy=False)
+        if outdata_flat_T is None:
+            # each weight is read once and applied to all extra dims
+            outdata_flat_T = np.zeros((n_out, n_extra), dtype=dtype)
+            csr_matvecs(n_out, n_in, n_extra,
+                        weights.indptr, weights.indices, data,
+                        np.ascontiguousarray(indata_flat.T,
+                                             dtype=dtype).ravel(),
+                        outdata_flat_T.ravel())
+        else:
+            # out is C-ordered, so write it one extra dim at a time
+            outdata_flat_T[...] = 0
+            indata_flat = np.ascontiguousarray(indata_flat, dtype=dtype)
+            outdata_flat = outdata_flat_T.T
+            for j in range(n_extra):
+                csr_matvec(n_out, n_in, weights.indptr, weights.indices,
+                           data, indata_flat[j], outdata_flat[j])
+    elif outdata_flat_T is None:
+        outdata_flat_T = weights.dot(indata_flat.T)
+    else:
+        outdata_flat_T[...] = weights.dot(indata_flat.T)
+
+    if out is not None:
+        return out
 
     # unflattened output array
-    outdata = outdata_flat.reshape(
-        [*extra_shape, shape_out[0], shape_out[1]])
-    return outdata
+    return outdata_flat_T.T.reshape(outdata_shape)
+
+if numba is not None:
+    @numba.njit(boundscheck=False, cache=True)
+    def _apply_weights_row(indptr, indices, data, indata_flat_T,
+                           outdata_flat_T, i):
+        '''Output values of grid box ``i``, see ``_apply_weights_numba()``.'''
+        n_extra = indata_flat_T.shape[1]
+        for j in range(n_extra):
+            outdata_flat_T[i, j] = 0
+        # each weight is loaded once and applied to all extra dims
+        for k in range(indptr[i], indptr[i+1]):
+            w = data[k]
+            col = indices[k]
+            for j in range(n_extra):
+                outdata_flat_T[i, j] += w * indata_flat_T[col, j]
+
+    @numba.njit(parallel=True, boundscheck=False, cache=True)
+    def _apply_weights_numba(indptr, indices, data, indata_flat_T,
+                             outdata_flat_T):
+        '''
+        Multi-threaded CSR matrix multiplication, used by ``apply_weights()``
+        if numba is installed.
+
+        Output grid boxes are independent of each other, so they are split
+        across threads without any locking. Each output value is summed in the
+        same order as scipy, so results agree with the scipy code path.
+
+        Parameters
+        ----------
+        indptr, indices, data : numpy arrays
+            Arrays of the CSR weight matrix of shape ``(N_out, N_in)``.
+
+        indata_flat_T : C-ordered numpy array of shape ``(N_in, N_extra)``
+
+        outdata_flat_T : numpy array of shape ``(N_out, N_extra)``
+            Will be overwritten in-place.
+        '''
+        for i in numba.prange(outdata_flat_T.shape[0]):
+            _apply_weights_row(indptr, indices, data, indata_flat_T,
+                               outdata_flat_T, i)
+
+    @numba.njit(boundscheck=False, cache=True)
+    def _apply_weights_numba_serial(indptr, indices, data, indata_flat_T,
+                                    outdata_flat_T):
+        '''Single-threaded version of ``_apply_weights_numba()``.'''
+        for i in range(outdata_flat_T.shape[0]):
+            _apply_weights_row(indptr, indices, data, indata_flat_T,
+                               outdata_flat_T, i)
+
+
+def _numba_kernel():
+    '''
+    Pick the numba kernel for the current thread.
+
+    The multi-threaded kernel is only used from the main thread. Other
+    threads are typically dask workers regridding chunks in parallel already:
+    starting a numba thread pool in each of them would oversubscribe the CPUs,
+    and numba's fallback "workqueue" threading layer (used if neither TBB nor
+    OpenMP is installed) even aborts the process when called concurrently.
+    '''
+    if threading.current_thread() is threading.main_thread():
+        return _apply_weights_numba
+    return _apply_weights_numba_serial
@@ -188,6 +188,107 @@ def test_regrid():
     os.remove(filename)
 
 
+def test_apply_weights_numba():
+    pytest.importorskip('numba')
+    import scipy.sparse as sps
+
+    shape_in = lon_in.shape
+    shape_out = lon_out.shape
+    weights = sps.random(lon_out.size, lon_in.size, density=0.01,
+                         format='coo', random_state=0)
+
+    # COO matrix uses scipy, CSR matrix uses numba
+    data4D_out_scipy = apply_weights(weights, data4D_in, shape_in, shape_out)
+    data4D_out_numba = apply_weights(weights.tocsr(), data4D_in,
+                                     shape_in, shape_out)
+    assert_almost_equal(data4D_out_numba, data4D_out_scipy, decimal=10)
+
+    # non-native byte order is not supported by numba, falls back to scipy
+    data4D_out_swapped = apply_weights(weights.tocsr(),
+                                       data4D_in.astype('>f8'),
+                                       shape_in, shape_out)
+    assert_equal(data4D_out_swapped, data4D_out_numba)
+
+    # dask calls it from several threads at once, e.g. regrid_dask()
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(4) as executor:
+        data_out_threads = list(executor.map(
+            lambda data: apply_weights(weights.tocsr(), data,
+                                       shape_in, shape_out),
+            data4D_in))
+    assert_equal(np.stack(data_out_threads), data4D_out_numba)
+
+
+def test_apply_weights_out(monkeypatch):
+    import scipy.sparse as sps
+    import xesmf.smm
+
+    shape_in = lon_in.shape
+    shape_out = lon_out.shape
+    weights = sps.random(lon_out.size, lon_in.size, density=0.01,
+                         format='csr', random_state=0)
+
+    data4D_out = apply_weights(weights, data4D_in, shape_in, shape_out)
+
+    out = np.empty(data4D_out.shape)
+    assert apply_weights(weights, data4D_in, shape_in, shape_out,
+                         out=out) is out
+    assert_equal(out, data4D_out)
+
+    # the output is written to out directly, without a full-size temporary.
+    # The numba kernel makes a transposed copy of the input, so use scipy.
+    monkeypatch.setattr(xesmf.smm, 'numba', None)
+    apply_weights(weights, data4D_in, shape_in, shape_out, out=out)
+    import tracemalloc
+    tracemalloc.start()
+    apply_weights(weights, data4D_in, shape_in, shape_out, out=out)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    assert peak < out.nbytes // 10
+    assert_equal(out, data4D_out)
+
+    with pytest.raises(ValueError):
+        apply_weights(weights, data4D_in, shape_in, shape_out,
+                      out=np.empty(data4D_out.shape[1:]))
+    with pytest.raises(ValueError):
+        apply_weights(weights, data4D_in, shape_in, shape_out,
+                      out=np.empty(data4D_out.shape, dtype=np.float32))
+    with pytest.raises(ValueError):
+        apply_weights(weights, data4D_in, shape_in, shape_out,
+                      out=np.empty(data4D_out.shape, order='F'))
+
+
+def test_apply_weights_all_nan():
+    import scipy.sparse as sps
+
+    shape_in = lon_in.shape
+    shape_out = lon_out.shape
+    weights = sps.random(lon_out.size, lon_in.size, density=0.001,
+                         format='csr', random_state=0)
+
+    # skipping the weights should give the same result as applying them,
+    # i.e. NaN where there are weights and 0 for unmapped grid boxes
+    data_nan = np.full(data4D_in.shape, np.nan)
+    data_out_ref = weights.dot(data_nan.reshape(-1, lon_in.size).T).T
+    weights_list = [weights, weights.tocoo()]
+    if hasattr(sps, 'csr_array'):  # scipy >= 1.8
+        weights_list += [sps.csr_array(weights), sps.coo_array(weights)]
+    for w in weights_list:
+        data_out = apply_weights(w, data_nan, shape_in, shape_out)
+        assert_equal(data_out.reshape(data_out_ref.shape), data_out_ref)
+        assert np.any(data_out == 0)
+
+    # a single value is enough for the weights to be applied, wherever it is
+    from xesmf.smm import _all_nan
+    data_nan = data_nan.reshape(-1, lon_in.size)
+    assert _all_nan(data_nan)
+    for index in [(0, 0), (-1, -1), (123, 45)]:
+        data_partial = data_nan.copy()
+        data_partial[index] = 1
+        assert not _all_nan(data_partial)
+        assert not _all_nan(data_partial, chunk_size=100)
+
+
 def test_regrid_periodic_wrong():
 
     # not using periodic grid
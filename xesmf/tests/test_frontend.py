@@ -92,6 +92,66 @@ def test_existing_weights():
     xe.Regridder(ds_in, ds_out, method)
 
 
+def test_weights_csr():
+    import scipy.sparse as sps
+
+    regridder = xe.Regridder(ds_in, ds_out, 'bilinear')
+    assert sps.isspmatrix_csr(regridder.weights)
+    assert regridder.weights.has_sorted_indices
+
+    # weights written to disk should read back the same
+    fn = regridder.to_netcdf('test_weights_csr.nc')
+    regridder_reuse = xe.Regridder(ds_in, ds_out, 'bilinear', weights=fn)
+    assert (regridder_reuse.weights != regridder.weights).nnz == 0
+    os.remove(fn)
+
+    # or reuse the weights of another regridder directly
+    regridder_reuse = xe.Regridder(ds_in, ds_out, 'bilinear',
+                                   weights=regridder.weights)
+    assert (regridder_reuse.weights != regridder.weights).nnz == 0
+    assert xe.get_regridder(ds_in, ds_out, 'bilinear',
+                            weights=regridder.weights).weights.nnz > 0
+
+
+def test_default_filename():
+    fn = xe.Regridder(ds_in, ds_out, 'bilinear')._get_default_filename()
+    assert fn.startswith('bilinear_15x18_20x24_')
+    assert fn == xe.Regridder(ds_in, ds_out, 'bilinear')._get_default_filename()
+
+    # the grids hashed by get_regridder() give the same filename
+    xe.clear_regridder_cache()
+    assert fn == xe.get_regridder(ds_in, ds_out,
+                                  'bilinear')._get_default_filename()
+    xe.clear_regridder_cache()
+
+    # grids of the same shape but different coordinates
+    ds_out_shifted = ds_out.copy()
+    ds_out_shifted['lon'] = ds_out['lon'] + 1
+    assert fn != xe.Regridder(ds_in, ds_out_shifted,
+                              'bilinear')._get_default_filename()
+
+
+def test_get_regridder_cached():
+    xe.clear_regridder_cache()
+
+    regridder = xe.get_regridder(ds_in, ds_out, 'bilinear')
+    assert xe.get_regridder(ds_in, ds_out, 'bilinear') is regridder
+
+    # options at their default values are the same options
+    assert xe.get_regridder(ds_in, ds_out, 'bilinear',
+                            periodic=False) is regridder
+    assert xe.get_regridder(ds_in, ds_out, method='bilinear',
+                            extrap=None) is regridder
+
+    # different options or grids should not reuse the regridder
+    assert xe.get_regridder(ds_in, ds_out, 'bilinear',
+                            periodic=True) is not regridder
+    assert xe.get_regridder(ds_in, ds_in, 'bilinear') is not regridder
+
+    xe.clear_regridder_cache()
+    assert xe.get_regridder(ds_in, ds_out, 'bilinear') is not regridder
+
+
 def test_conservative_without_bounds():
     with pytest.raises(KeyError):
         xe.Regridder(ds_in.drop_vars('lon_b'), ds_out, 'conservative')
@@ -188,6 +248,27 @@ def test_regrid_dataarray():
     xr.testing.assert_identical(dr_out_4D['lev'], ds_in['lev'])
 
 
+def test_regrid_wrong_shape():
+    regridder = xe.Regridder(ds_in, ds_out, 'bilinear')
+
+    with pytest.raises(ValueError):
+        regridder(ds_out['data_ref'].values)
+
+
+def test_regrid_dataarray_float32():
+    regridder = xe.Regridder(ds_in, ds_out, 'conservative')
+
+    dr_out = regridder(ds_in['data4D'])
+    dr_out_f32 = regridder(ds_in['data4D'].astype(np.float32))
+    assert dr_out_f32.dtype == np.float32
+    assert_almost_equal(dr_out_f32.values, dr_out.values, decimal=3)
+
+    # dask should know the output dtype in advance
+    dr_out_f32 = regridder(ds_in_chunked['data4D'].astype(np.float32))
+    assert dr_out_f32.dtype == np.float32
+    assert dr_out_f32.compute().dtype == np.float32
+
+
 def test_regrid_dataarray_to_locstream():
     # xarray.DataArray containing in-memory numpy array
 
@@ -324,6 +405,33 @@ def test_regrid_dataset():
     assert_equal(ds_result['lon'].values, ds_out['lon'].values)
 
 
+def test_regrid_dataset_fused():
+    # all variables are regridded together, should give the same result
+    # as regridding them one by one
+    regridder = xe.Regridder(ds_in, ds_out, 'conservative')
+
+    ds_temp = ds_in.copy()
+    ds_temp['data4D_f32'] = ds_in['data4D'].astype(np.float32)
+    ds_temp['data4D_T'] = ds_in['data4D'].transpose('y', 'time', 'x', 'lev')
+    ds_temp['no_horiz'] = ds_in['time'] * 2
+    ds_result = regridder(ds_temp)
+
+    # variables without horizontal dimensions are dropped
+    assert 'no_horiz' not in ds_result
+
+    for name in ['data', 'data4D', 'data4D_f32']:
+        xr.testing.assert_equal(ds_result[name], regridder(ds_temp[name]))
+        assert ds_result[name].dtype == ds_temp[name].dtype
+
+    xr.testing.assert_equal(ds_result['data4D_T'], ds_result['data4D'])
+
+    # lazy output declares the dtype it computes to
+    ds_dask = regridder(ds_temp.drop_vars('no_horiz').chunk({'time': 3}))
+    for name, dr in ds_dask.data_vars.items():
+        assert dr.dtype == ds_result[name].dtype
+    xr.testing.assert_allclose(ds_dask.compute(), ds_result)
+
+
 def test_regrid_dataset_to_locstream():
     # xarray.Dataset containing in-memory numpy array
 